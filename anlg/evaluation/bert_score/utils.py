@@ -1,4 +1,5 @@
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from math import log
 from itertools import chain
 from collections import defaultdict, Counter
@@ -195,16 +196,39 @@ def bert_cos_score_idf(model, refs, hyps, tokenizer, idf_dict,
         - :param: `batch_size` (int): bert score processing batch size
         - :param: `device` (str): device to use, e.g. 'cpu' or 'cuda'
     """
-    preds = []
-    iter_range = range(0, len(refs), batch_size)
+    # Embed every distinct sentence once. Sorting by length keeps the padding
+    # inside each embedding batch small. The embeddings are cached on the CPU,
+    # so device memory stays bounded by one batch whatever the corpus size.
+    sentences = sorted(set(refs + hyps), key=lambda sen: len(sen.split()), reverse=True)
+    stats_dict = {}
+    iter_range = range(0, len(sentences), batch_size)
     if verbose: iter_range = tqdm(iter_range)
     for batch_start in iter_range:
+        sen_batch = sentences[batch_start:batch_start+batch_size]
+        embs, lens, masks, padded_idf = get_bert_embedding(sen_batch, model, tokenizer, idf_dict,
+                                                           device=device)
+        embs = embs.cpu()
+        for i, sen in enumerate(sen_batch):
+            sen_len = lens[i].item()
+            # clone, so the padded batch is not kept alive by views into it
+            stats_dict[sen] = (embs[i, :sen_len].clone(), padded_idf[i, :sen_len].clone())
+
+    def pad_batch_stats(sen_batch):
+        embs, idfs = zip(*[stats_dict[sen] for sen in sen_batch])
+        lens = torch.LongTensor([e.size(0) for e in embs])
+        # pad embeddings with a non-zero value so that normalizing them in
+        # greedy_cos_idf does not produce NaNs (padding is masked out there)
+        embs = pad_sequence(embs, batch_first=True, padding_value=2.0)
+        idfs = pad_sequence(idfs, batch_first=True)
+        masks = (torch.arange(embs.size(1)).unsqueeze(0) < lens.unsqueeze(1)).long()
+        return embs.to(device), lens.to(device), masks.to(device), idfs
+
+    preds = []
+    for batch_start in range(0, len(refs), batch_size):
         batch_refs = refs[batch_start:batch_start+batch_size]
         batch_hyps = hyps[batch_start:batch_start+batch_size]
-        ref_stats = get_bert_embedding(batch_refs, model, tokenizer, idf_dict,
-                                       device=device)
-        hyp_stats = get_bert_embedding(batch_hyps, model, tokenizer, idf_dict,
-                                       device=device)
+        ref_stats = pad_batch_stats(batch_refs)
+        hyp_stats = pad_batch_stats(batch_hyps)
 
         P, R, F1 = greedy_cos_idf(*ref_stats, *hyp_stats)
         preds.append(torch.stack((P, R, F1), dim=1).cpu())
@@ -12,9 +12,11 @@ from anlg.evaluation.bleu.bleu_scorer import BleuScorer
 
 
 class Bleu:
-    def __init__(self, n=4):
+    def __init__(self, n=4, use_numba=False):
         # default compute Blue score up to 4
         self._n = n
+        # count n-grams with the numba-compiled kernel in ngram_jit (requires numba)
+        self._use_numba = use_numba
         self._hypo_for_image = {}
         self.ref_for_image = {}
 
@@ -24,6 +26,8 @@ class Bleu:
         imgIds = gts.keys()
 
         bleu_scorer = BleuScorer(n=self._n)
+        hypos = []
+        refs = []
         for id in imgIds:
             hypo = res[id]
             ref = gts[id]
@@ -34,7 +38,16 @@ class Bleu:
             assert(type(ref) is list)
             assert(len(ref) >= 1)
 
-            bleu_scorer += (hypo[0], ref)
+            if self._use_numba:
+                hypos.append(hypo[0])
+                refs.append(ref)
+            else:
+                bleu_scorer += (hypo[0], ref)
+
+        if self._use_numba:
+            from anlg.evaluation.bleu.ngram_jit import cook_tests
+
+            bleu_scorer.extend_cooked(*cook_tests(hypos, refs, n=self._n))
 
         #score, scores = bleu_scorer.compute_score(option='shortest')
         score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
@@ -120,6 +120,14 @@ class BleuScorer(object):
 
         self._score = None ## need to recompute
 
+    def extend_cooked(self, reflens, ctest):
+        '''add segments cooked in bulk (see ngram_jit.cook_tests); only the
+        reference lengths are kept for the refs.'''
+
+        self.crefs.extend((reflen, None) for reflen in reflens)
+        self.ctest.extend(ctest)
+        self._score = None ## need to recompute
+
     def ratio(self, option=None):
         self.compute_score(option=option)
         return self._ratio
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+# check_ngram_jit.py
+#
+# Checks that ngram_jit.cook_tests cooks segments exactly like cook_refs/cook_test
+# in bleu_scorer.py. Run with: python -m anlg.evaluation.bleu.check_ngram_jit
+
+from anlg.evaluation.bleu.bleu_scorer import cook_refs, cook_test
+from anlg.evaluation.bleu.ngram_jit import cook_tests
+
+SEGMENTS = [
+    # single reference
+    ("the cat sat on the mat", ["the cat is on the mat"]),
+    # repeated n-grams in the test are clipped by the reference counts
+    ("the the the the the the the", ["the cat is on the mat"]),
+    ("a b a b a b a b", ["a b a b", "b a b a b a"]),
+    # multiple references, counts are clipped by the maximum over the references
+    ("he went to the store to buy milk", ["he went to the shop", "she went to the store to buy some milk", "milk"]),
+    # test shorter than the n-gram order, and words unseen in any reference
+    ("hello", ["hello there", "hi"]),
+    ("completely unrelated words", ["nothing in common here"]),
+    ("", ["an empty test sentence"]),
+]
+
+
+def check(segments, n=4):
+    tests = [test for test, _ in segments]
+    refs_list = [refs for _, refs in segments]
+    reflens, ctest = cook_tests(tests, refs_list, n=n)
+
+    for (test, refs), reflen, cooked in zip(segments, reflens, ctest):
+        expected_reflen, refmaxcounts = cook_refs(refs, n=n)
+        expected = cook_test(test, (expected_reflen, refmaxcounts), n=n)
+        assert reflen == expected_reflen, (test, refs, reflen, expected_reflen)
+        assert cooked == expected, (test, refs, cooked, expected)
+
+
+if __name__ == "__main__":
+    check(SEGMENTS)
+    print("ngram_jit.cook_tests matches cook_refs/cook_test on %d segments" % len(SEGMENTS))
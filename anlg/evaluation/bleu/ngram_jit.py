@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# ngram_jit.py
+#
+# Numba-compiled replacement for precook/cook_refs/cook_test in bleu_scorer.py.
+# Sentences are mapped to int32 word ids once, and clipped n-gram counts for all
+# (test, refs) segments are computed in a single compiled, parallel loop.
+
+import numba
+import numpy as np
+
+
+def _to_ids(sentences, vocab):
+    lens = np.zeros(len(sentences) + 1, dtype=np.int64)
+    ids = []
+    for i, s in enumerate(sentences):
+        words = s.split()
+        ids.extend(vocab.setdefault(w, len(vocab)) for w in words)
+        lens[i + 1] = len(words)
+    return np.array(ids, dtype=np.int32), np.cumsum(lens)
+
+
+@numba.njit(cache=True)
+def _ngram_equal(a, i, b, j, k):
+    for m in range(k):
+        if a[i + m] != b[j + m]:
+            return False
+    return True
+
+
+@numba.njit(cache=True)
+def _ngram_count(ngram_src, i, sent, start, end, k):
+    count = 0
+    for j in range(start, end - k + 1):
+        if _ngram_equal(ngram_src, i, sent, j, k):
+            count += 1
+    return count
+
+
+@numba.njit(cache=True, parallel=True)
+def _clipped_ngram_counts(tests, test_offsets, refs, ref_offsets, ref_groups, n):
+    '''For every test sentence and n-gram order k, sums min(count in test, max count in any of its refs)
+    over the distinct n-grams of the test sentence.
+    Sentences are short, so n-grams are compared pairwise instead of being hashed.'''
+    num_tests = len(test_offsets) - 1
+    correct = np.zeros((num_tests, n), dtype=np.int64)
+    for t in numba.prange(num_tests):
+        start, end = test_offsets[t], test_offsets[t + 1]
+        for k in range(1, n + 1):
+            for i in range(start, end - k + 1):
+                # only count each distinct n-gram once, at its first occurrence
+                seen = False
+                for j in range(start, i):
+                    if _ngram_equal(tests, i, tests, j, k):
+                        seen = True
+                        break
+                if seen:
+                    continue
+                test_count = _ngram_count(tests, i, tests, i, end, k)
+                max_ref_count = 0
+                for r in range(ref_groups[t], ref_groups[t + 1]):
+                    ref_count = _ngram_count(tests, i, refs, ref_offsets[r], ref_offsets[r + 1], k)
+                    if ref_count > max_ref_count:
+                        max_ref_count = ref_count
+                correct[t, k - 1] += min(test_count, max_ref_count)
+    return correct
+
+
+def cook_tests(tests, refs_list, n=4):
+    '''Takes the test sentences and, for each of them, its list of reference
+    sentences, and returns the reference lengths and cooked tests, as
+    cook_refs and cook_test would for each segment.'''
+
+    vocab = {}
+    test_ids, test_offsets = _to_ids(tests, vocab)
+    ref_ids, ref_offsets = _to_ids([ref for refs in refs_list for ref in refs], vocab)
+    ref_groups = np.cumsum([0] + [len(refs) for refs in refs_list]).astype(np.int64)
+
+    correct = _clipped_ngram_counts(test_ids, test_offsets, ref_ids, ref_offsets, ref_groups, n)
+
+    test_lens = np.diff(test_offsets).tolist()
+    ref_lens = np.diff(ref_offsets).tolist()
+    reflens = [ref_lens[ref_groups[t]:ref_groups[t + 1]] for t in range(len(tests))]
+
+    ctest = []
+    for reflen, testlen, correct_counts in zip(reflens, test_lens, correct.tolist()):
+        ctest.append({
+            "reflen": reflen,
+            "testlen": testlen,
+            "guess": [max(0, testlen - k + 1) for k in range(1, n + 1)],
+            "correct": correct_counts,
+        })
+    return reflens, ctest
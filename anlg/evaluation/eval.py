@@ -1,13 +1,24 @@
 import json
+import os
 import sys
 from argparse import ArgumentParser
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 
 from anlg.evaluation.bert_score.bert_score import BertScore
 from anlg.evaluation.bleu.bleu import Bleu
 from anlg.evaluation.cider.cider import Cider
 from anlg.evaluation.meteor.meteor_nltk import Meteor
 from anlg.evaluation.rouge.rouge import Rouge
+from utils.file_utils import to_json_line
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# Scorers that are safe to run for several models in parallel processes (BERTScore runs on the GPU)
+CPU_SCORER_METHODS = ["Bleu", "METEOR", "Rouge", "CIDEr"]
 
 # reload(sys)
 # sys.setdefaultencoding('utf-8')
@@ -15,30 +26,51 @@ from anlg.evaluation.rouge.rouge import Rouge
 
 class QGEvalCap:
     # gts: 正解, res: 生成されたやつ
-    def __init__(self, model_key, gts, res, results_file):
+    def __init__(self, model_key, gts, res, results_file, use_numba=False):
         self.gts = gts
         self.res = res
         self.results_file = results_file
         self.model_key = model_key
+        self.use_numba = use_numba
 
-    def evaluate(self):
-        output = []
-        scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
+    def scorers(self):
+        return [
+            (Bleu(4, use_numba=self.use_numba), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
             (Meteor(), "METEOR"),
             (Rouge(), "ROUGE_L"),
             (Cider(), "CIDEr"),
             (BertScore(), "Bert Score"),
         ]
 
+    def compute_scores(self, methods):
+        """
+        Run only the scorers whose method() is in `methods`; returns method() -> (score, scores)
+        """
+        return {
+            scorer.method(): scorer.compute_score(self.gts, self.res)
+            for scorer, _ in self.scorers()
+            if scorer.method() in methods
+        }
+
+    def evaluate(self, precomputed=None, results_writer=None):
+        """
+        precomputed: scores already returned by compute_scores (e.g. in a worker process), not recomputed here
+        results_writer: open binary file the scores are written to instead of appending to results_file
+        """
+        output = []
+        precomputed = precomputed if precomputed is not None else {}
+
         # =================================================
         # Compute scores
         # =================================================
         scores_dict = {}
         scores_dict["model_key"] = self.model_key
-        for scorer, method in scorers:
+        for scorer, method in self.scorers():
             # print 'computing %s score...'%(scorer.method())
-            score, scores = scorer.compute_score(self.gts, self.res)
+            if scorer.method() in precomputed:
+                score, scores = precomputed[scorer.method()]
+            else:
+                score, scores = scorer.compute_score(self.gts, self.res)
             if type(method) == list:
                 for sc, scs, m in zip(score, scores, method):
                     print("%s: %0.5f" % (m, sc))
@@ -49,85 +81,73 @@ class QGEvalCap:
                 output.append(score)
                 scores_dict[method] = score
 
-        with open(self.results_file, "a") as f:
-            f.write(json.dumps(scores_dict) + "\n")
+        if results_writer is not None:
+            results_writer.write(to_json_line(scores_dict))
+        else:
+            with open(self.results_file, "ab") as f:
+                f.write(to_json_line(scores_dict))
 
         return output
 
 
-def eval(model_key, sources, references, predictions, results_file):
-    # source: (obs1, obs2), reference: hyp（正解）, prediction: generation（生成されたやつ）
+def eval(model_key, gts, res, results_file, use_numba=False, precomputed=None, results_writer=None):
+    # gts: (obs1, obs2) -> hyps（正解）, res: (obs1, obs2) -> generations（生成されたやつ）
     """
-    Given a filename, calculate the metric scores for that prediction file
-    isDin: boolean value to check whether input file is DirectIn.txt
+    Given the references and predictions of a model, calculate the metric scores for that model
     """
+    QGEval = QGEvalCap(model_key, gts, res, results_file, use_numba=use_numba)
+    return QGEval.evaluate(precomputed, results_writer)
 
-    pairs = []
-
-    for tup in sources:
-        pair = {}
-        pair["tokenized_sentence"] = tup
-        pairs.append(pair)
-
-    cnt = 0
-    for line in references:
-        pairs[cnt]["tokenized_question"] = line
-        cnt += 1
-
-    output = predictions
-
-    for idx, pair in enumerate(pairs):
-        pair["prediction"] = output[idx]
 
-    ## eval
-    import json
-    from json import encoder
-
-    from anlg.evaluation.eval import QGEvalCap
+def compute_cpu_scores(model_key, gts, res, use_numba=False):
+    """
+    Compute the CPU-only metrics of a model; meant to run in a worker process
+    """
+    QGEval = QGEvalCap(model_key, gts, res, None, use_numba=use_numba)
+    return QGEval.compute_scores(CPU_SCORER_METHODS)
 
-    encoder.FLOAT_REPR = lambda o: format(o, ".4f")
 
-    res = defaultdict(lambda: [])
-    gts = defaultdict(lambda: [])
-    for pair in pairs[:]:
-        key = pair["tokenized_sentence"]
-        # res[key] = [pair['prediction']]
-        res[key] = pair["prediction"]
+def init_cpu_worker():
+    """
+    Keep numba's parallel BLEU kernel to one thread per worker, the workers already use every core
+    """
+    os.environ["NUMBA_NUM_THREADS"] = "1"
 
-        ## gts
-        # 正解
-        gts[key].append(pair["tokenized_question"])
 
-    # gts: 正解, res: 生成されたやつ
-    QGEval = QGEvalCap(model_key, gts, res, results_file)
-    return QGEval.evaluate()
-
-
-def preprocess(file_name, keys):
-    with open(file_name) as f:
-        data = f.readlines()
-        generations = [json.loads(elem) for elem in data]
-
-    predictions = {}
-    references = {}
-    sources = {}
-    keys_list = keys if keys != None else generations[0]["generations"].keys()
-    for key in keys_list:
-        references[key] = []
-        predictions[key] = []
-        sources[key] = []
-
-    for elem in generations:
-        label = elem["label"]
-        hyp = elem["hyp" + label]
+def preprocess(file_name, keys, sample_index=0):
+    """
+    sample_index: which of the generations stored per record (see --num_samples of run_generation.py) to score
+    """
+    gts = {}
+    res = {}
+    with open(file_name, "rb", buffering=1 << 16) as f:
+        generations = (json_loads(line) for line in f)
+        first = next(generations, None)
+        if first is None:
+            return gts, res
+        keys_list = keys if keys != None else list(first["generations"].keys())
         for key in keys_list:
-            if key in elem["generations"]:
-                references[key].append(hyp)
-                predictions[key].append(elem["generations"][key])
-                sources[key].append((elem["obs1"], elem["obs2"]))
-
-    # source: (obs1, obs2), reference: hyp（正解）, prediction: generation（生成されたやつ）
-    return sources, references, predictions
+            gts[key] = {}
+            res[key] = {}
+
+        for line_no, elem in enumerate(chain([first], generations), 1):
+            label = elem["label"]
+            hyp = elem["hyp" + label]
+            source = (elem["obs1"], elem["obs2"])
+            for key in keys_list:
+                if key in elem["generations"]:
+                    samples = elem["generations"][key]
+                    if not 0 <= sample_index < len(samples):
+                        raise ValueError(
+                            "Record {} of {} ({}) has {} generation(s) for {}, cannot score --sample_index {}".format(
+                                line_no, file_name, source, len(samples), key, sample_index
+                            )
+                        )
+                    gts[key].setdefault(source, []).append(hyp)
+                    res[key][source] = [samples[sample_index]]
+
+    # gts: 正解, res: 生成されたやつ (per model key, keyed by (obs1, obs2))
+    return gts, res
 
 
 if __name__ == "__main__":
@@ -135,6 +155,13 @@ if __name__ == "__main__":
     parser.add_argument("-gen_file", "--gen_file", dest="gen_file", help="generations file with gold/references")
     parser.add_argument("--keys", type=str, default=None, help="comma-separated list of model keys")
     parser.add_argument("--results_file", default="eval_results.jsonl")
+    parser.add_argument(
+        "--num_workers", type=int, default=None, help="processes for the CPU metrics (default: one per model key)"
+    )
+    parser.add_argument(
+        "--sample_index", type=int, default=0, help="which generation of each record to score, if several were sampled"
+    )
+    parser.add_argument("--use_numba", action="store_true", help="count BLEU n-grams with numba (requires numba)")
     args = parser.parse_args()
 
     print("scores: \n")
@@ -142,7 +169,21 @@ if __name__ == "__main__":
     if args.keys:
         keys = args.keys.split(",")
 
-    sources, references, predictions = preprocess(args.gen_file, keys)
-    for key in references.keys():
-        print("\nEvaluating %s" % key)
-        eval(key, sources[key], references[key], predictions[key], args.results_file)
+    gts, res = preprocess(args.gen_file, keys, args.sample_index)
+    num_workers = args.num_workers if args.num_workers else max(1, min(len(gts), os.cpu_count()))
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_cpu_worker) as executor, open(
+        args.results_file, "ab", buffering=1 << 16
+    ) as results_writer:
+        # CPU metrics of all models are computed in parallel, BERTScore and the results file
+        # are handled here one model at a time, in order
+        futures = {
+            key: executor.submit(compute_cpu_scores, key, gts[key], res[key], use_numba=args.use_numba)
+            for key in gts.keys()
+        }
+        for key in gts.keys():
+            print("\nEvaluating %s" % key)
+            QGEval = QGEvalCap(key, gts[key], res[key], args.results_file, use_numba=args.use_numba)
+            # BERTScore runs before waiting on the worker, so it overlaps the CPU metrics of the same model
+            precomputed = QGEval.compute_scores(["Bert Score"])
+            precomputed.update(futures[key].result())
+            QGEval.evaluate(precomputed, results_writer)
@@ -19,33 +19,20 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
+import hashlib
+import importlib
 import json
 import logging
+import os
+import pickle
+from collections import defaultdict
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 import tqdm
-from pytorch_transformers import (
-    GPT2Config,
-    GPT2LMHeadModel,
-    GPT2Tokenizer,
-    OpenAIGPTConfig,
-    OpenAIGPTLMHeadModel,
-    OpenAIGPTTokenizer,
-    TransfoXLConfig,
-    TransfoXLLMHeadModel,
-    TransfoXLTokenizer,
-    XLNetConfig,
-    XLNetLMHeadModel,
-    XLNetTokenizer,
-)
 
-import comet.interactive.functions as comet_interactive
-from anlg.models import GPT2CometLMHeadModel
-from anlg.run_lm_finetuning import anli_record_to_gpt_prompt, record_to_text_tokens_with_comet_pred
-from anlg.tokenizers import AnliCometGpt2Tokenizer, AnliGpt2Tokenizer
-from utils.file_utils import read_jsonl_lines, read_lines, write_items
+from utils.file_utils import read_jsonl_lines, read_lines, write_items, write_jsonl_lines
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s", datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO
@@ -56,23 +43,44 @@ logging.getLogger("pytorch_transformers.tokenization_utils").setLevel(logging.CR
 
 MAX_LENGTH = int(10000)  # Hardcoded max length to avoid infinite loop
 
-ALL_MODELS = sum(
-    (
-        tuple(conf.pretrained_config_archive_map.keys())
-        for conf in (GPT2Config, OpenAIGPTConfig, XLNetConfig, TransfoXLConfig)
-    ),
-    (),
-)
-
+# Model and tokenizer classes are given as "module:class" and only imported for the selected model type,
+# which keeps pytorch_transformers, COMeT and the finetuning code out of e.g. `--help`
 MODEL_CLASSES = {
-    "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
-    "openai-gpt": (OpenAIGPTLMHeadModel, OpenAIGPTTokenizer),
-    "xlnet": (XLNetLMHeadModel, XLNetTokenizer),
-    "transfo-xl": (TransfoXLLMHeadModel, TransfoXLTokenizer),
-    "gpt2_for_anli": (GPT2CometLMHeadModel, AnliGpt2Tokenizer),
-    "gpt2_for_anli_comet": (GPT2CometLMHeadModel, AnliCometGpt2Tokenizer),
+    "gpt2": ("pytorch_transformers:GPT2LMHeadModel", "pytorch_transformers:GPT2Tokenizer"),
+    "openai-gpt": ("pytorch_transformers:OpenAIGPTLMHeadModel", "pytorch_transformers:OpenAIGPTTokenizer"),
+    "xlnet": ("pytorch_transformers:XLNetLMHeadModel", "pytorch_transformers:XLNetTokenizer"),
+    "transfo-xl": ("pytorch_transformers:TransfoXLLMHeadModel", "pytorch_transformers:TransfoXLTokenizer"),
+    "gpt2_for_anli": ("anlg.models:GPT2CometLMHeadModel", "anlg.tokenizers:AnliGpt2Tokenizer"),
+    "gpt2_for_anli_comet": ("anlg.models:GPT2CometLMHeadModel", "anlg.tokenizers:AnliCometGpt2Tokenizer"),
 }
 
+# Files of a local model directory that determine how prompts are tokenized
+TOKENIZER_FILES = ["vocab.json", "merges.txt", "added_tokens.json", "special_tokens_map.json"]
+
+
+def _import_class(path):
+    module_name, class_name = path.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_model_classes(model_type):
+    """Returns the (model class, tokenizer class) of a model type"""
+    return tuple(_import_class(path) for path in MODEL_CLASSES[model_type])
+
+
+def all_models():
+    """Shortcut names of all pretrained models of the library"""
+    from pytorch_transformers import GPT2Config, OpenAIGPTConfig, TransfoXLConfig, XLNetConfig
+
+    return sum(
+        (
+            tuple(conf.pretrained_config_archive_map.keys())
+            for conf in (GPT2Config, OpenAIGPTConfig, XLNetConfig, TransfoXLConfig)
+        ),
+        (),
+    )
+
+
 # Padding text to help Transformer-XL and XLNet with short prompts as proposed by Aman Rusia
 # in https://github.com/rusiaaman/XLNet-gen#methodology
 # and https://medium.com/@amanrusia/xlnet-speaks-comparison-to-gpt-2-ea1a4e9ba39e
@@ -95,35 +103,34 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
-def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
-    """Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
+def sample_next_token(logits, top_k=0, top_p=0.0, max_nucleus_size=512):
+    """Sample one token per row from a distribution of logits using top-k and/or nucleus (top-p) filtering
     Args:
-        logits: logits distribution shape (vocabulary size)
+        logits: logits distribution shape (batch size x vocabulary size)
         top_k > 0: keep only top k tokens with highest probability (top-k filtering).
         top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
             Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-    From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
+        max_nucleus_size: without top-k, the nucleus is searched among this many most likely tokens only.
+    Returns the sampled token ids, shape (batch size x 1).
+    Filtering is done on the output of a single torch.topk instead of sorting and masking the whole vocabulary.
     """
-    assert logits.dim() == 1  # batch size 1 for now - could be updated for more but the code would be less clear
-    top_k = min(top_k, logits.size(-1))  # Safety check
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+    if top_k <= 0 and top_p <= 0.0:
+        return torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
 
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+    num_candidates = top_k if top_k > 0 else max_nucleus_size
+    candidate_logits, candidate_indices = torch.topk(logits, min(num_candidates, logits.size(-1)))
 
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
+    if top_p > 0.0:
+        # Probabilities are normalized over the top-k tokens, or over the whole vocabulary without top-k
+        normalizer = torch.logsumexp(candidate_logits if top_k > 0 else logits, dim=-1, keepdim=True)
+        probs = torch.exp(candidate_logits - normalizer)
+        # Remove tokens once the cumulative probability before them is above the threshold,
+        # which keeps the first token above the threshold
+        indices_to_remove = (torch.cumsum(probs, dim=-1) - probs) > top_p
+        candidate_logits = candidate_logits.masked_fill(indices_to_remove, -float("Inf"))
 
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
-    return logits
+    next_token = torch.multinomial(F.softmax(candidate_logits, dim=-1), num_samples=1)
+    return candidate_indices.gather(-1, next_token)
 
 
 def sample_sequence(
@@ -138,41 +145,83 @@ def sample_sequence(
     device="cpu",
     comet_input=None,
     comet_mask=None,
+    use_past=False,
+    fp16=False,
+    stop_token_ids=None,
+    staging=None,
 ):
-    context = torch.tensor(context, dtype=torch.long, device=device)
-    context = context.unsqueeze(0).repeat(num_samples, 1)
+    """Sample continuations for a batch of prompts.
+
+    `context` is a list of token id lists that must all have the same length, so the batch can be
+    decoded without padding. Each prompt is repeated `num_samples` times; the returned tensor has
+    `len(context) * num_samples` rows, with the samples of a prompt on consecutive rows.
+
+    With `use_past`, the hidden states returned by the model are fed back through `past`, so every step
+    after the first only runs the newly sampled token (GPT-2 models only).
+
+    With `fp16`, decoding runs under CUDA autocast; logits are cast back to fp32 before sampling.
+
+    Decoding stops early once every row has produced one of `stop_token_ids`; rows that are already done keep
+    emitting their stop token, so callers must truncate the output at the first stop token.
+
+    `staging` is an optional pinned CPU buffer of at least `len(context) * len(context[0])` elements; the prompts
+    are written into it and copied to the device asynchronously.
+    """
+    if staging is not None:
+        context_size = len(context) * len(context[0])
+        staging.numpy()[:context_size] = np.ravel(context)
+        context = staging[:context_size].view(len(context), -1).to(device, non_blocking=True)
+    else:
+        context = torch.tensor(context, dtype=torch.long, device=device)
+    context = context.repeat_interleave(num_samples, dim=0)
 
     if comet_input is not None:
-        comet_input = torch.tensor(comet_input, dtype=torch.long, device=device)
-        comet_input = comet_input.unsqueeze(0).repeat(num_samples, 1, 1)
+        comet_input = torch.tensor(np.asarray(comet_input), dtype=torch.long, device=device)
+        comet_input = comet_input.repeat_interleave(num_samples, dim=0)
 
-        comet_mask = torch.tensor(comet_mask, dtype=torch.float, device=device)
-        comet_mask = comet_mask.unsqueeze(0).repeat(num_samples, 1, 1)
+        comet_mask = torch.tensor(np.asarray(comet_mask), dtype=torch.float, device=device)
+        comet_mask = comet_mask.repeat_interleave(num_samples, dim=0)
 
     generated = context
-    with torch.no_grad():
+    batch_size = generated.size(0)
+    past = None
+    if stop_token_ids:
+        stop_tokens = torch.tensor(stop_token_ids, dtype=torch.long, device=device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    # Autocast is entered once for the whole loop, so its cache of fp16 weight casts is reused across steps
+    with torch.inference_mode(), torch.cuda.amp.autocast(enabled=fp16):
         for _ in range(length):
-            inputs = {"input_ids": generated}
-            if comet_input is not None:
-                inputs["comet_input"] = comet_input
-                inputs["comet_mask"] = comet_mask
+            if past is not None:
+                # The prompt and COMeT embeddings are already part of the cached hidden states
+                inputs = {"input_ids": generated[:, -1:], "past": past}
+            else:
+                inputs = {"input_ids": generated}
+                if comet_input is not None:
+                    inputs["comet_input"] = comet_input
+                    inputs["comet_mask"] = comet_mask
             if is_xlnet:
                 # XLNet is a direct (predict same token, not next token) and bi-directional model by default
                 # => need one additional dummy token in the input (will be masked), attention mask and target mapping (see model docstring)
-                input_ids = torch.cat((generated, torch.zeros((1, 1), dtype=torch.long, device=device)), dim=1)
-                perm_mask = torch.zeros((1, input_ids.shape[1], input_ids.shape[1]), dtype=torch.float, device=device)
+                input_ids = torch.cat((generated, torch.zeros((batch_size, 1), dtype=torch.long, device=device)), dim=1)
+                perm_mask = torch.zeros(
+                    (batch_size, input_ids.shape[1], input_ids.shape[1]), dtype=torch.float, device=device
+                )
                 perm_mask[:, :, -1] = 1.0  # Previous tokens don't see last token
-                target_mapping = torch.zeros((1, 1, input_ids.shape[1]), dtype=torch.float, device=device)
-                target_mapping[0, 0, -1] = 1.0  # predict last token
+                target_mapping = torch.zeros((batch_size, 1, input_ids.shape[1]), dtype=torch.float, device=device)
+                target_mapping[:, 0, -1] = 1.0  # predict last token
                 inputs = {"input_ids": input_ids, "perm_mask": perm_mask, "target_mapping": target_mapping}
 
-            outputs = model(
-                **inputs
-            )  # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet (cached hidden-states)
-            next_token_logits = outputs[0][0, -1, :] / temperature
-            filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
-            next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=num_samples)
-            generated = torch.cat((generated, next_token.unsqueeze(0)), dim=1)
+            outputs = model(**inputs)
+            if use_past:
+                past = outputs[1]
+            next_token_logits = outputs[0][:, -1, :].float() / temperature
+            next_token = sample_next_token(next_token_logits, top_k=top_k, top_p=top_p)
+            if stop_token_ids:
+                next_token = next_token.masked_fill(done.unsqueeze(-1), stop_token_ids[0])
+                done = done | (next_token == stop_tokens).any(dim=-1)
+            generated = torch.cat((generated, next_token), dim=1)
+            if stop_token_ids and done.all():
+                break
     return generated
 
 
@@ -190,7 +239,7 @@ def main():
         default=None,
         type=str,
         required=True,
-        help="Path to pre-trained model or shortcut name selected in the list: " + ", ".join(ALL_MODELS),
+        help="Path to pre-trained model or shortcut name of a pretrained model of the library",
     )
     parser.add_argument("--input-file", type=str, default=None, help="File to load instance prompts from")
     parser.add_argument(
@@ -208,6 +257,7 @@ def main():
     parser.add_argument("--top_p", type=float, default=0.9)
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
+    parser.add_argument("--fp16", action="store_true", help="Run the model in mixed precision (CUDA only)")
 
     parser.add_argument("--include_comet", default=False, type=bool, help="To include comet predictions or not")
     parser.add_argument(
@@ -218,24 +268,46 @@ def main():
     parser.add_argument(
         "--restrict_comet", default=False, type=bool, help="Restrict comet features to only o1's effect and o2's causes"
     )
-    parser.add_argument("--num_samples", default=1, type=int, help="No. of samples to obtain.")
+    parser.add_argument(
+        "--num_samples",
+        default=1,
+        type=int,
+        help="No. of samples to obtain per prompt. Without --task, the samples of each input line are written on "
+        "consecutive output lines; with --task anli, each record stores the list of its samples.",
+    )
+    parser.add_argument(
+        "--no_cache", action="store_true", help="Do not read or write the cache of tokenized anli prompts"
+    )
+    parser.add_argument(
+        "--batch_size", default=16, type=int, help="No. of prompts of the same token length to decode together."
+    )
 
     args = parser.parse_args()
 
     args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
     args.n_gpu = torch.cuda.device_count()
+    args.fp16 = args.fp16 and args.device.type == "cuda"
 
     set_seed(args)
 
     args.model_type = args.model_type.lower()
-    model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    model_class, tokenizer_class = get_model_classes(args.model_type)
     tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
+    # The tokenizer is checked before the model, whose config loading fails outright on a bad path
+    if tokenizer is None:
+        parser.error(
+            "Could not load {}. Expected a path to a pre-trained model or one of: {}".format(
+                args.model_name_or_path, ", ".join(all_models())
+            )
+        )
     model = model_class.from_pretrained(args.model_name_or_path)
     model.to(args.device)
 
     comet_text_encoder = None
     if args.include_comet and not args.comet_as_text:
         logging.info("Setting comet model")
+        import comet.interactive.functions as comet_interactive
+
         opt, state_dict, vocab = comet_interactive.load_model_file(args.comet_model_path)
         # print(opt)
         comet_data_loader, comet_text_encoder = comet_interactive.load_data("atomic", opt, vocab, args.comet_vocab_path)
@@ -259,14 +331,25 @@ def main():
 
     print(args)
 
-    def _prompt_to_gen(txt, comet_event_inputs, comet_attention_masks):
+    # Generations of the anli models are cut at the end-of-explanation tag by the tokenizer (and at the first
+    # period for gpt2_for_anli on the anli task), so sampling can stop once every row has emitted one of those.
+    # Finished rows are filled with the end-of-explanation tag, which decoding removes.
+    stop_token_ids = None
+    if args.model_type in ["gpt2_for_anli", "gpt2_for_anli_comet"]:
+        stop_token_ids = tokenizer.convert_tokens_to_ids([tokenizer.eexpl_token])
+        if args.model_type == "gpt2_for_anli" and args.task == "anli":
+            stop_token_ids.append(tokenizer.convert_tokens_to_ids(["."])[0])
+
+    def _encode_prompt(txt):
         if args.model_type in ["transfo-xl", "xlnet"]:
             # Models with memory likes to have a long prompt for short inputs.
             txt = (args.padding_text if args.padding_text else PADDING_TEXT) + txt
-        context_tokens = tokenizer.encode(txt)
+        return tokenizer.encode(txt)
+
+    def _batch_to_gen(contexts_tokens, comet_event_inputs=None, comet_attention_masks=None, staging=None):
         out = sample_sequence(
             model=model,
-            context=context_tokens,
+            context=contexts_tokens,
             length=args.length,
             temperature=args.temperature,
             top_k=args.top_k,
@@ -276,68 +359,162 @@ def main():
             comet_input=comet_event_inputs,
             comet_mask=comet_attention_masks,
             num_samples=args.num_samples,
+            use_past=args.model_type in ["gpt2", "gpt2_for_anli", "gpt2_for_anli_comet"],
+            fp16=args.fp16,
+            stop_token_ids=stop_token_ids,
+            staging=staging,
         )
-        out = out[0, len(context_tokens) :].tolist()
-        text = tokenizer.decode(out, clean_up_tokenization_spaces=True)
-        return text
+        out = out[:, len(contexts_tokens[0]) :].tolist()
+        texts = [tokenizer.decode(o, clean_up_tokenization_spaces=True) for o in out]
+        # The samples of a prompt are on consecutive rows
+        return [texts[i : i + args.num_samples] for i in range(0, len(texts), args.num_samples)]
+
+    def _prompt_to_gen(txt, comet_event_inputs=None, comet_attention_masks=None):
+        return _batch_to_gen(
+            [_encode_prompt(txt)],
+            None if comet_event_inputs is None else [comet_event_inputs],
+            None if comet_attention_masks is None else [comet_attention_masks],
+        )[0]
+
+    def _prompts_to_gens(contexts_tokens, comet_event_inputs=None, comet_attention_masks=None):
+        if not contexts_tokens:
+            return []
+
+        # Prompts of equal token length are decoded together, so batches never need padding
+        buckets = defaultdict(list)
+        for i, tokens in enumerate(contexts_tokens):
+            buckets[len(tokens)].append(i)
+
+        # One pinned buffer is reused for the host-to-device copy of every batch. Reusing it is safe since each
+        # batch's output is copied back to the host before the next batch is written
+        staging = None
+        if args.device.type == "cuda":
+            max_prompt_len = max(len(tokens) for tokens in contexts_tokens)
+            staging = torch.empty(args.batch_size * max_prompt_len, dtype=torch.long).pin_memory()
+
+        gens = [None] * len(contexts_tokens)
+        with tqdm.tqdm(total=len(contexts_tokens)) as pbar:
+            for indices in buckets.values():
+                for start in range(0, len(indices), args.batch_size):
+                    batch = indices[start : start + args.batch_size]
+                    batch_gens = _batch_to_gen(
+                        [contexts_tokens[i] for i in batch],
+                        None if comet_event_inputs is None else [comet_event_inputs[i] for i in batch],
+                        None if comet_attention_masks is None else [comet_attention_masks[i] for i in batch],
+                        staging,
+                    )
+                    for i, gen in zip(batch, batch_gens):
+                        gens[i] = gen
+                    pbar.update(len(batch))
+        return gens
+
+    def _encode_anli_records(records):
+        from anlg.run_lm_finetuning import anli_record_to_gpt_prompt, record_to_text_tokens_with_comet_pred
+
+        contexts_tokens = []
+        comet_inputs = []
+        comet_masks = []
+        for idx, record in enumerate(records):
+            input_text_tokens = None
+            comet_event_inputs = None
+            comet_attention_masks = None
+
+            if args.model_type == "gpt2_for_anli_comet":
+                (
+                    input_text_tokens,
+                    comet_event_inputs,
+                    comet_attention_masks,
+                ) = record_to_text_tokens_with_comet_pred(
+                    tokenizer=tokenizer,
+                    record=record,
+                    is_eval=True,
+                    comet_as_text=args.comet_as_text,
+                    include_comet=args.include_comet,
+                    comet_text_encoder=comet_text_encoder,
+                    restrict_comet=args.restrict_comet,
+                )
+            elif args.model_type == "gpt2_for_anli":
+                input_text_tokens = anli_record_to_gpt_prompt(tokenizer=tokenizer, record=record, is_eval=True)
+
+            input_text = " ".join(input_text_tokens)
+            contexts_tokens.append(_encode_prompt(input_text))
+            comet_inputs.append(comet_event_inputs)
+            comet_masks.append(comet_attention_masks)
+
+            if idx < 5:
+                print("Input context format: {}".format(input_text_tokens))
+                if comet_event_inputs is not None:
+                    print("Comet event input format: {}".format(comet_event_inputs))
+                    print("Comet mask: {}".format(comet_attention_masks))
+        return contexts_tokens, comet_inputs, comet_masks
 
     if args.input_file is None:
         while True:
             raw_text = args.prompt if args.prompt else input("Model prompt >>> ")
-            text = _prompt_to_gen(raw_text)
-            print(text)
+            for text in _prompt_to_gen(raw_text):
+                print(text)
             if args.prompt:
                 break
     else:
         if args.task is None:
             lines = read_lines(args.input_file)
-            generations = []
-            for l in lines:
-                generations.append(_prompt_to_gen(l))
-            write_items(generations, args.output_file)
+            generations = _prompts_to_gens([_encode_prompt(l) for l in lines])
+            write_items([text for samples in generations for text in samples], args.output_file)
         elif args.task == "anli":
             records = read_jsonl_lines(args.input_file)
-            idx = 0
-            for record in tqdm.tqdm(records):
-                input_text_tokens = None
-                comet_event_inputs = None
-                comet_attention_masks = None
-
-                if args.model_type == "gpt2_for_anli_comet":
-                    (
-                        input_text_tokens,
-                        comet_event_inputs,
-                        comet_attention_masks,
-                    ) = record_to_text_tokens_with_comet_pred(
-                        tokenizer=tokenizer,
-                        record=record,
-                        is_eval=True,
-                        comet_as_text=args.comet_as_text,
-                        include_comet=args.include_comet,
-                        comet_text_encoder=comet_text_encoder,
-                        restrict_comet=args.restrict_comet,
-                    )
-                elif args.model_type == "gpt2_for_anli":
-                    input_text_tokens = anli_record_to_gpt_prompt(tokenizer=tokenizer, record=record, is_eval=True)
 
-                input_text = " ".join(input_text_tokens)
-                gen = _prompt_to_gen(input_text, comet_event_inputs, comet_attention_masks)
+            directory, filename = os.path.split(args.input_file)
+            with open(args.input_file, "rb") as f:
+                cache_key = hashlib.sha1(f.read())
+            cache_key.update(
+                json.dumps(
+                    [
+                        args.model_type,
+                        args.model_name_or_path,
+                        args.include_comet,
+                        args.comet_as_text,
+                        args.restrict_comet,
+                        args.comet_vocab_path,
+                    ]
+                ).encode()
+            )
+            # The tokenizer files are hashed too, so retraining a model into the same directory
+            # does not reuse prompts encoded with its old vocabulary
+            for tokenizer_file in TOKENIZER_FILES:
+                tokenizer_path = os.path.join(args.model_name_or_path, tokenizer_file)
+                if os.path.isfile(tokenizer_path):
+                    with open(tokenizer_path, "rb") as f:
+                        cache_key.update(f.read())
+            cached_prompts_file = os.path.join(directory, f"cached_prompts_{cache_key.hexdigest()}_{filename}")
+
+            if not args.no_cache and os.path.exists(cached_prompts_file):
+                logger.info("Loading prompts from cached file %s", cached_prompts_file)
+                with open(cached_prompts_file, "rb") as handle:
+                    contexts_tokens, comet_inputs, comet_masks = pickle.load(handle)
+            else:
+                contexts_tokens, comet_inputs, comet_masks = _encode_anli_records(records)
+                if not args.no_cache:
+                    logger.info("Saving prompts into cached file %s", cached_prompts_file)
+                    with open(cached_prompts_file, "wb") as handle:
+                        pickle.dump(
+                            (contexts_tokens, comet_inputs, comet_masks), handle, protocol=pickle.HIGHEST_PROTOCOL
+                        )
+
+            has_comet_inputs = len(comet_inputs) > 0 and comet_inputs[0] is not None
+            gens = _prompts_to_gens(
+                contexts_tokens,
+                comet_inputs if has_comet_inputs else None,
+                comet_masks if has_comet_inputs else None,
+            )
+
+            for record, samples in zip(records, gens):
                 if args.model_type == "gpt2_for_anli":
-                    period_idx = gen.find(".")
-                    if period_idx != -1:
-                        gen = gen[:period_idx]
+                    samples = [gen[: gen.find(".")] if "." in gen else gen for gen in samples]
 
                 if "generations" not in record:
                     record["generations"] = {}
-                record["generations"][args.model_type] = [gen]
-
-                if idx < 5:
-                    print("Input context format: {}".format(input_text_tokens))
-                    if comet_event_inputs is not None:
-                        print("Comet event input format: {}".format(comet_event_inputs))
-                        print("Comet mask: {}".format(comet_attention_masks))
-                idx += 1
-            write_items([json.dumps(r) for r in records], args.output_file)
+                record["generations"][args.model_type] = samples
+            write_jsonl_lines(records, args.output_file)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,13 @@
-from typing import List
+from typing import Iterable, List
 import json
 import gzip
 import csv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def write_items(items: List[str], output_file):
     with open(output_file, 'w') as f:
@@ -11,6 +16,18 @@ def write_items(items: List[str], output_file):
     f.close()
 
 
+def to_json_line(item) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(item, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+    return (json.dumps(item) + "\n").encode()
+
+
+def write_jsonl_lines(items: Iterable[dict], output_file):
+    with open(output_file, 'wb', buffering=1 << 16) as f:
+        for item in items:
+            f.write(to_json_line(item))
+
+
 def read_lines(input_file: str) -> List[str]:
     lines = []
     with open(input_file, "rb") as f: